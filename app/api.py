@@ -2,11 +2,14 @@
 import os
 import json
 import shutil
+import asyncio
+from typing import Optional
 from fastapi import FastAPI, UploadFile, File
 from pydantic import BaseModel
 # from app.ingestion import clone_repo, ingest_repo_to_vector_db, ingest_file_to_vector_db
 from app.rag import RAGPipeline
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from app.ingest_github_repo import ingest_changed_files
 
 REPO_URL_FILE = "data/repo_url.json"
@@ -67,14 +70,14 @@ class RepoInput(BaseModel):
     branch: str = "main"
 
 @app.post("/ingest")
-def ingest_repo_endpoint(input: RepoInput):
+async def ingest_repo_endpoint(input: RepoInput):
     """
     Clones a GitHub repo and ingests its contents into the vector database.
     """
     try:
         # path = clone_repo(input.repo_url, input.branch)
         # ingest_repo_to_vector_db(path)
-        ingest_changed_files(input.repo_url, input.branch)
+        await ingest_changed_files(input.repo_url, input.branch)
         save_repoUrl(input.repo_url, input.branch)
         return {"message": f"Repo ingested successfully "}
     except Exception as e:
@@ -86,29 +89,60 @@ def ingest_repo_endpoint(input: RepoInput):
 class QueryRequest(BaseModel):
     query: str
 
+# Shared by all requests; built at startup so the first query doesn't pay for loading it
+RAG: Optional[RAGPipeline] = None
+
+def get_rag() -> RAGPipeline:
+    global RAG
+    if RAG is None:
+        RAG = RAGPipeline()
+    return RAG
+
+@app.on_event("startup")
+def _warm():
+    try:
+        get_rag()
+    except Exception as e:
+        # Keep serving ingestion endpoints; /query retries the load on first use
+        print(f"[WARN] Could not warm up RAG pipeline: {e}")
+
 @app.post("/query")
-def ask_question(request: QueryRequest):
+async def ask_question(request: QueryRequest):
     """
     Accepts a user query and returns an answer using the RAG pipeline.
     """
-    rag = RAGPipeline()
-    result = rag.run(request.query)
+    rag = await asyncio.to_thread(get_rag)
+    result = await rag.arun(request.query)
     
     return {
         "answer": result["answer"],
         "sources": result["source_files"]
     }
 
+@app.post("/query/stream")
+async def ask_question_stream(request: QueryRequest):
+    """
+    Same as /query, but streams the answer as Server-Sent Events while the LLM generates it.
+    Each event is a JSON object: {"token": "..."} for answer text, then a final {"sources": [...]}.
+    """
+    rag = await asyncio.to_thread(get_rag)
+
+    async def events():
+        async for event in rag.run_stream(request.query):
+            yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 
 #---------------------------
 # Sync Endpoint
 # --------------------------
 
 @app.post("/sync")
-def sync_documentation():
+async def sync_documentation():
     repoUrl=load_repoUrl()
     try:
-        ingest_changed_files(repoUrl.get("repo_url"),repoUrl.get("branch"))
+        await ingest_changed_files(repoUrl.get("repo_url"),repoUrl.get("branch"))
         return {"message": "Synced Succesfully"}
     except Exception as e:
         return {"error": str(e)}
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+Local embedding backend: BAAI/bge-large-en-v1.5 exported to ONNX with int8 dynamic quantization
+and run on ONNX Runtime, which uses VNNI int8 dot products on recent x86 CPUs.
+
+Exposes the same embed_documents / embed_query interface as LangChain's embedding clients, so
+VectorStore can use it in place of GoogleGenerativeAIEmbeddings (EMBEDDING_BACKEND=onnx).
+
+One-time export:
+    optimum-cli export onnx --model BAAI/bge-large-en-v1.5 --task feature-extraction --optimize O3 bge-onnx/
+    optimum-cli onnxruntime quantize --avx512_vnni --onnx_model bge-onnx/ -o bge-onnx-int8/
+"""
+
+from typing import List, Optional
+
+import numpy as np
+
+# Batch sizes per device: large batches keep a GPU busy, small ones keep CPU padding waste low
+CPU_BATCH_SIZE = 32
+GPU_BATCH_SIZE = 128
+
+# BGE's recommended prefix for short retrieval queries; passages are embedded as-is
+BGE_QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+
+
+class OnnxEmbeddings:
+    def __init__(
+        self,
+        model_dir: str = "bge-onnx-int8",
+        tokenizer_name: str = "BAAI/bge-large-en-v1.5",
+        file_name: str = "model_quantized.onnx",
+        batch_size: Optional[int] = None,
+        max_length: int = 512,
+        provider: Optional[str] = None
+    ):
+        """
+        Args:
+            model_dir (str): Directory holding the exported ONNX model.
+            file_name (str): Model file inside model_dir.
+            batch_size (int): Texts per forward pass; defaults to a per-device size.
+            provider (str): ONNX Runtime execution provider; defaults to CUDA when available, else CPU.
+        """
+        # Imported lazily so the default Google backend doesn't need optimum installed
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if provider is None:
+            gpu = "CUDAExecutionProvider" in onnxruntime.get_available_providers()
+            provider = "CUDAExecutionProvider" if gpu else "CPUExecutionProvider"
+        print(f"ONNX embeddings running on {provider}")
+
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=file_name, provider=provider)
+        if batch_size is None:
+            batch_size = GPU_BATCH_SIZE if provider == "CUDAExecutionProvider" else CPU_BATCH_SIZE
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Runs the encoder in batches and returns L2-normalized CLS embeddings (BGE's pooling), in input order.
+        """
+        # Batching texts of similar length keeps padding (wasted encoder work) to a minimum
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype="float32")
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            outputs = self.model(**inputs)
+            embeddings[batch] = np.asarray(outputs.last_hidden_state[:, 0], dtype="float32")
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        if not texts:
+            return []
+        return list(self._encode(texts))
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self._encode([BGE_QUERY_INSTRUCTION + text])[0]
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        return self._encode([BGE_QUERY_INSTRUCTION + text for text in texts])
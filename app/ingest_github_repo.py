@@ -1,12 +1,34 @@
+import asyncio
+import httpx
 import requests
 import os
 import json
+import sqlite3
+import hashlib
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List
-from app.vectore_store import VectorStore
-from app.utils import hybrid_pdf_extraction,extract_text_from_image
+from typing import Dict, List, Optional, Set, Tuple, Union
+from app.vectore_store import VectorStore, get_vector_store
+from app.utils import extract_pdf_bytes,extract_text_from_image
 
 COMMIT_FILE = "data/last_commit.json"
+# Images are not ingested, so they are never downloaded
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif"}
+# Max simultaneous downloads from raw.githubusercontent.com
+RAW_FETCH_CONCURRENCY = 32
+# Syncs touching fewer files than this fetch them one by one; larger ones download the tarball
+TARBALL_MIN_FILES = 20
+# Raw-file ETags from the last successful ingest, sent back as If-None-Match
+ETAG_DB = "data/etags.db"
+
+GITHUB_HEADERS = {"Accept": "application/vnd.github+json"}
+if os.getenv("GH_TOKEN"):
+    GITHUB_HEADERS["Authorization"] = f"token {os.getenv('GH_TOKEN')}"
+
+# Kept alive across calls so repeated GitHub requests skip the TCP/TLS handshake
+SESSION = requests.Session()
+SESSION.headers.update(GITHUB_HEADERS)
 
 
 def save_last_commit(repo: str, commit_sha: str):
@@ -21,16 +43,79 @@ def load_last_commit() -> dict:
     return {}
 
 
-def get_latest_commit_sha(owner: str, repo: str, branch: str = "main") -> str:
+_client: Optional[httpx.AsyncClient] = None
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the shared async GitHub client for the running event loop.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            http2=True,
+            headers=GITHUB_HEADERS,
+            limits=httpx.Limits(max_connections=RAW_FETCH_CONCURRENCY),
+            follow_redirects=True
+        )
+        _client_loop = loop
+    return _client
+
+
+def _etag_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(ETAG_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS etags (url TEXT PRIMARY KEY, etag TEXT NOT NULL)")
+    return conn
+
+
+def load_etags(urls: List[str]) -> Dict[str, str]:
+    conn = _etag_db()
+    try:
+        etags = {}
+        for url in urls:
+            row = conn.execute("SELECT etag FROM etags WHERE url = ?", (url,)).fetchone()
+            if row:
+                etags[url] = row[0]
+        return etags
+    finally:
+        conn.close()
+
+
+def save_etags(etags: Dict[str, str]):
+    conn = _etag_db()
+    try:
+        conn.executemany("INSERT OR REPLACE INTO etags (url, etag) VALUES (?, ?)", etags.items())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def forget_etags(urls: List[str]):
+    """
+    Drops stored ETags for files indexed from somewhere other than their raw URL,
+    so a later If-None-Match can't match content the index no longer holds.
+    """
+    conn = _etag_db()
+    try:
+        conn.executemany("DELETE FROM etags WHERE url = ?", [(url,) for url in urls])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def get_latest_commit_sha(client: httpx.AsyncClient, owner: str, repo: str, branch: str = "main") -> str:
     url = f"https://api.github.com/repos/{owner}/{repo}/commits/{branch}"
-    res = requests.get(url)
+    res = await client.get(url)
     res.raise_for_status()
     return res.json()["sha"]
 
 
-def get_changed_files(owner: str, repo: str, base_sha: str, head_sha: str):
+async def get_changed_files(client: httpx.AsyncClient, owner: str, repo: str, base_sha: str, head_sha: str):
     url = f"https://api.github.com/repos/{owner}/{repo}/compare/{base_sha}...{head_sha}"
-    res = requests.get(url)
+    res = await client.get(url)
     res.raise_for_status()
     files = res.json().get("files", [])
     changed = []
@@ -43,60 +128,185 @@ def get_changed_files(owner: str, repo: str, base_sha: str, head_sha: str):
     return changed, deleted
 
 
-def ingest_changed_files(repo_url: str, branch: str = "main"):
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """
+    Returns the shared process pool used for PDF parsing/OCR, one worker per core.
+    Created on first use so importing this module doesn't spawn processes.
+    """
+    global _pdf_executor
+    if _pdf_executor is None:
+        _pdf_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _pdf_executor
+
+
+def _file_ext(path: str) -> str:
+    return path[path.rfind('.'):].lower() if '.' in path else ''
+
+
+def raw_file_url(owner: str, repo: str, branch: str, path: str) -> str:
+    return f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
+
+
+async def fetch_raw_files(client: httpx.AsyncClient, owner: str, repo: str, branch: str, paths: List[str]) -> List[Union[httpx.Response, Exception]]:
+    """
+    Downloads raw file contents concurrently over the client's HTTP/2 connection pool.
+    Files whose stored ETag still matches come back as bodiless 304 responses.
+
+    Returns:
+        One response per path, in order; a failed download is returned as its exception.
+    """
+    semaphore = asyncio.Semaphore(RAW_FETCH_CONCURRENCY)
+    etags = load_etags([raw_file_url(owner, repo, branch, path) for path in paths])
+
+    async def _fetch(path: str) -> httpx.Response:
+        url = raw_file_url(owner, repo, branch, path)
+        headers = {"If-None-Match": etags[url]} if url in etags else None
+        async with semaphore:
+            return await client.get(url, headers=headers)
+
+    return await asyncio.gather(*[_fetch(path) for path in paths], return_exceptions=True)
+
+
+def fetch_tarball_files(owner: str, repo: str, sha: str, paths: Optional[Set[str]] = None) -> List[Tuple[str, bytes]]:
+    """
+    Streams the repository snapshot at `sha` as a single gzipped tarball.
+
+    Args:
+        paths: Only return these repo paths; None returns every non-image file.
+
+    Returns:
+        List of (repo path, file bytes) tuples.
+    """
+    url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{sha}"
+    files = []
+    with SESSION.get(url, stream=True) as res:
+        res.raise_for_status()
+        with tarfile.open(fileobj=res.raw, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # Members sit under a "<owner>-<repo>-<short sha>/" root folder
+                path = member.name.split("/", 1)[-1]
+                if _file_ext(path) in IMAGE_EXTS or (paths is not None and path not in paths):
+                    continue
+                files.append((path, tar.extractfile(member).read()))
+    print(f"Extracted {len(files)} files from tarball.")
+    return files
+
+
+def index_files(vs: VectorStore, files: List[Tuple[str, bytes]]) -> Set[str]:
+    """
+    Extracts text from downloaded files and upserts them into the vector store in one batch.
+    Files whose bytes match what is already indexed are skipped before any extraction.
+    PDFs are parsed (and OCR'd) in parallel across the process pool.
+
+    Returns:
+        Set[str]: Paths whose current content is now indexed (upserted or already up to date);
+        files that failed extraction or had no text are left out.
+    """
+    stored_hashes = vs.get_content_hashes([path for path, _ in files])
+    indexed = set()
+    changed = []
+    for path, content in files:
+        content_hash = hashlib.sha256(content).hexdigest()
+        if stored_hashes.get(path) == content_hash:
+            print(f"[{path}] Skipping: No changes.")
+            indexed.add(path)
+            continue
+        changed.append((path, content, content_hash))
+
+    # The cores are split between the PDFs being parsed at once, so a lone scanned PDF still
+    # OCRs its pages on every core while a batch of them runs one page per PDF at a time
+    n_pdfs = sum(1 for path, *_ in changed if _file_ext(path) == ".pdf")
+    ocr_workers = max(1, (os.cpu_count() or 1) // max(1, n_pdfs))
+
+    extracted = []
+    for path, content, content_hash in changed:
+        if _file_ext(path) == ".pdf":
+            text = get_pdf_executor().submit(extract_pdf_bytes, content, ocr_workers)
+        else:
+            text = content.decode("utf-8", errors="ignore")
+        extracted.append((path, text, content_hash))
+
+    documents = []
+    for path, text, content_hash in extracted:
+        if not isinstance(text, str):
+            try:
+                text = text.result()
+            except Exception as e:
+                print(f"Failed to extract text from: {path} ({e})")
+                continue
+
+        if len(text):
+            print(f"Queued for ingestion: {path}")
+            documents.append((path, text, content_hash))
+        else:
+            print(f"Empty content for: {path}")
+
+    # Embed all changed files in one batch
+    vs.upsert_documents(documents)
+    indexed.update(path for path, *_ in documents)
+    return indexed
+
+
+async def ingest_changed_files(repo_url: str, branch: str = "main"):
     parts = repo_url.rstrip("/").split("/")
     owner, repo = parts[-2], parts[-1]
 
-    latest_sha = get_latest_commit_sha(owner, repo, branch)
+    client = get_client()
+    latest_sha = await get_latest_commit_sha(client, owner, repo, branch)
     state = load_last_commit()
 
     if state.get("repo") == repo and state.get("commit") == latest_sha:
         print("No new commit. Skipping ingestion.")
         return
 
-    vs = VectorStore()
-    
+    # Loading the index and embedding are blocking, so they run off the event loop
+    vs = await asyncio.to_thread(get_vector_store)
+
     if state.get("repo") == repo:
-        changed_files, deleted_files = get_changed_files(owner, repo, state["commit"], latest_sha)
+        changed_files, deleted_files = await get_changed_files(client, owner, repo, state["commit"], latest_sha)
     else:
-        # First time: fetch all files from HEAD
-        tree_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-        tree_res = requests.get(tree_url)
-        tree_res.raise_for_status()
-        changed_files = [f["path"] for f in tree_res.json().get("tree", []) if f["type"] == "blob"]
-        deleted_files = []
-        # print(changed_files)
+        # First time: every file at HEAD comes from the tarball
+        changed_files, deleted_files = None, []
 
     # Handle deleted files
     for path in deleted_files:
         print(f"Removing deleted file from vector DB: {path}")
-        vs.remove_document(path)
+        await asyncio.to_thread(vs.remove_document, path)
 
     # Handle added/modified files
-    for path in changed_files:
-        
-        raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
-        content_res = requests.get(raw_url)
-        # if(path.suffix().lower()==):
-        # ext=Path(path).suffix().lower()
-        ext = path[path.rfind('.'):].lower() if '.' in path else ''
-        # print(content_res.status_code)
-        print(ext)
-        if ext== ".pdf":
-            # print(content_res.text)
-            content_res.text=hybrid_pdf_extraction(content_res.content)
-        elif ext in {".png", ".jpg", ".jpeg", ".gif" }:
-            continue
-        #     print(content_res.content)
-        #     content_res.text=extract_text_from_image(content_res.content)
-
-        # print(content_res.text)
-        if content_res.status_code == 200 and len(content_res.text):
-            print(f"Re-ingesting file: {path}")
-            vs.remove_document(path)  # Remove old embedding if exists
-            # print(10)
-            vs.upsert(doc_id=path, content=content_res.text)
-        else:
-            print(f"Failed to fetch content for: {path} (status {content_res.status_code})")
+    new_etags = {}
+    # Deleted or tarball-fetched files must not 304 against an older raw ETag later
+    stale_etag_urls = [raw_file_url(owner, repo, branch, path) for path in deleted_files]
+    if changed_files is not None and len(changed_files) < TARBALL_MIN_FILES:
+        paths = [path for path in changed_files if _file_ext(path) not in IMAGE_EXTS]
+        responses = await fetch_raw_files(client, owner, repo, branch, paths)
+        files = []
+        for path, content_res in zip(paths, responses):
+            if isinstance(content_res, Exception):
+                print(f"Failed to fetch content for: {path} ({content_res})")
+            elif content_res.status_code == 304:
+                print(f"Unchanged since last ingest: {path}")
+            elif content_res.status_code != 200:
+                print(f"Failed to fetch content for: {path} (status {content_res.status_code})")
+            else:
+                files.append((path, content_res.content))
+                if content_res.headers.get("ETag"):
+                    new_etags[path] = content_res.headers["ETag"]
+    else:
+        wanted = None if changed_files is None else set(changed_files)
+        files = await asyncio.to_thread(fetch_tarball_files, owner, repo, latest_sha, wanted)
+        stale_etag_urls += [raw_file_url(owner, repo, branch, path) for path, _ in files]
+
+    indexed = await asyncio.to_thread(index_files, vs, files)
 
+    # Only remember ETags once their content is safely indexed, so a failed extraction is
+    # retried on the next sync instead of coming back as a 304
+    save_etags({
+        raw_file_url(owner, repo, branch, path): etag
+        for path, etag in new_etags.items() if path in indexed
+    })
+    if stale_etag_urls:
+        forget_etags(stale_etag_urls)
     save_last_commit(repo, latest_sha)
@@ -5,7 +5,7 @@ import stat
 from git import Repo
 
 from app.utils import load_text_files_from_dir, load_files_from_file_path
-from app.vectore_store import VectorStore
+from app.vectore_store import get_vector_store
 
 def handle_remove_readonly(func, path, exc_info):
     """
@@ -48,7 +48,7 @@ def ingest_repo_to_vector_db(repo_path: str):
     print(f"[INFO] Ingesting repository documents from: {repo_path}")
     docs = load_text_files_from_dir(repo_path)
     print("Loaded Docs")
-    vs = VectorStore()
+    vs = get_vector_store()
     print("Loaded Vectorstore")
     vs.upsert_documents(docs)
     print(f"[SUCCESS] Indexed {len(docs)} documents from repository.")
@@ -62,6 +62,6 @@ def ingest_file_to_vector_db(file_path: str):
     """
     print(f"[INFO] Ingesting single file from: {file_path}")
     docs = load_files_from_file_path(file_path)
-    vs = VectorStore()
+    vs = get_vector_store()
     vs.upsert_documents(docs)
     print(f"[SUCCESS] Indexed {len(docs)} documents from file.")
@@ -0,0 +1,113 @@
+"""
+Semantic query cache for the RAG pipeline.
+
+Embeddings of previously answered queries are bucketed with a random-projection LSH index
+(faiss.IndexLSH). A new query reuses a cached answer only when both gates pass:
+- its embedding is close to a cached query (cosine >= min_cosine), and
+- the documents retrieved for it largely overlap the ones the cached answer was grounded on
+  (Jaccard >= min_doc_overlap), so a paraphrase can't return an answer built on other context.
+Entries are also tagged with a scope (model, k and store generation), and only match queries
+made in the same scope, so re-ingested documents don't keep serving answers built on old content.
+"""
+
+import os
+import threading
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+from app.utils import load_packed, save_packed
+
+
+class SemanticQueryCache:
+    def __init__(
+        self,
+        dim: int,
+        index_path="index/query_cache.faiss",
+        entries_path="index/query_cache.msgpack.zst",
+        nbits: int = 256,
+        min_cosine: float = 0.95,
+        min_doc_overlap: float = 0.8,
+        candidates: int = 5,
+        max_entries: int = 1000
+    ):
+        self.index_path = index_path
+        self.entries_path = entries_path
+        self.min_cosine = min_cosine
+        self.min_doc_overlap = min_doc_overlap
+        self.candidates = candidates
+        # Oldest entries are dropped beyond this many, since both files are rewritten on every add
+        self.max_entries = max_entries
+        # lookup() and add() run on different request threads; index ids must match entries
+        self._lock = threading.Lock()
+
+        self.index = None
+        # Parallel to the LSH ids: (query_embedding, result, retrieved_doc_ids, scope)
+        self.entries: List[tuple] = []
+
+        if os.path.exists(self.index_path) and os.path.exists(self.entries_path):
+            self.index = faiss.read_index(self.index_path)
+            entries = load_packed(self.entries_path)
+            self.entries = [
+                (np.frombuffer(vec, dtype=np.float32), result, doc_ids, scope)
+                for vec, result, doc_ids, scope in entries
+            ] if all(len(entry) == 4 for entry in entries) else None
+
+        # Caches written before entries carried a scope are discarded
+        if self.index is None or self.index.d != dim or self.entries is None:
+            self.index = faiss.IndexLSH(dim, nbits)
+            self.entries = []
+
+    def lookup(self, query_vec: np.ndarray, doc_ids: List[str], scope: str) -> Optional[dict]:
+        """
+        Returns a cached result for a semantically equivalent, equally grounded query.
+
+        Args:
+            query_vec (np.ndarray): (1, dim) query embedding.
+            doc_ids (List[str]): Documents retrieved for the new query.
+            scope (str): Only entries added with the same scope can match.
+
+        Returns:
+            dict or None: The cached result on a hit, otherwise None.
+        """
+        with self._lock:
+            if self.index.ntotal == 0:
+                return None
+            _, I = self.index.search(query_vec, min(self.candidates, self.index.ntotal))
+            candidates = [self.entries[idx] for idx in I[0] if idx != -1]
+
+        retrieved = set(doc_ids)
+        for cached_vec, result, cached_doc_ids, cached_scope in candidates:
+            if cached_scope != scope:
+                continue
+            # Query embeddings come L2-normalized from VectorStore.embed_query, so the dot product is the cosine
+            if float(np.dot(query_vec[0], cached_vec)) < self.min_cosine:
+                continue
+            cached = set(cached_doc_ids)
+            union = retrieved | cached
+            if union and len(retrieved & cached) / len(union) >= self.min_doc_overlap:
+                return result
+        return None
+
+    def add(self, query_vec: np.ndarray, result: dict, doc_ids: List[str], scope: str):
+        """
+        Remembers an answered query and persists the cache to disk.
+        """
+        faiss.normalize_L2(query_vec)
+        with self._lock:
+            self.entries.append((np.asarray(query_vec[0], dtype=np.float32), result, list(doc_ids), scope))
+            if len(self.entries) > self.max_entries:
+                # LSH ids are positions in entries, so the index is rebuilt from the kept ones
+                self.entries = self.entries[-self.max_entries:]
+                self.index.reset()
+                self.index.add(np.vstack([entry[0] for entry in self.entries]))
+            else:
+                self.index.add(query_vec)
+            self.save()
+
+    def save(self):
+        """Writes the LSH index and entries to disk; callers hold the lock."""
+        faiss.write_index(self.index, self.index_path)
+        save_packed([(vec.tobytes(), *rest) for vec, *rest in self.entries], self.entries_path)
+
@@ -41,19 +41,70 @@ buffer = You are a helpful assistant. Answer questions with detailed, technicall
 """
 
 import os
+import asyncio
+import hashlib
+import threading
 from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
 from dotenv import load_dotenv
 
 from langchain.schema.messages import HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
 # from langchain_google_genai import ChatGoogleGenerativeAI
 
-from app.vectore_store import VectorStore
+from app.vectore_store import VectorStore, get_vector_store
+from app.query_cache import SemanticQueryCache
+from app.utils import load_packed, save_packed
 
 # Load environment variables from .env file
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
+ANSWER_CACHE_PATH = "index/answer_cache.msgpack.zst"
+# Oldest answers are dropped beyond this many, since the cache file is rewritten on every answer
+ANSWER_CACHE_MAX_ENTRIES = 1000
+# OpenRouter providers that only cache prompt prefixes marked with cache_control
+# (OpenAI, DeepSeek etc. cache repeated prefixes automatically)
+PROMPT_CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+
+SYSTEM_PROMPT = """You are a helpful assistant who understands the Godspeed Framework deeply. Always aim to provide technically sound, creative, and helpful answers to a wide range of user questions, using the documentation provided as context.
+
+**Rules:**
+1. Always read and understand the full user query and provided context before answering.
+   - If the answer can be fully derived from the context, then answer with thorough technical clarity using at least 1000 tokens when needed.
+   - If the answer cannot be fully derived from context, say so sincerely — unless you can add well-grounded insights from general training that logically extend the documentation.
+
+2. Be versatile:
+   - Explain concepts clearly when asked for definitions or meanings.
+   - Describe how components work when asked about mechanisms.
+   - Show how to build new things using given APIs or tools when asked for implementation help.
+
+3. Respond naturally and warmly if the user is just chatting.
+
+4. When including Bash commands:
+   - Format using fenced bash blocks:
+     ```bash
+     # example
+     godspeed run app.yaml
+     ```
+
+5. When using math or formulas:
+   - Always use inline LaTeX: wrap expressions like this — `$a^2 + b^2 = c^2$`.
+   - Use `$$` for display math on its own line, and always close math blocks properly.
+
+Your tone should be friendly but focused. If the user asks something unrelated to the documentation or framework, explain clearly that you are focused on helping with Godspeed-related tasks."""
+
+def build_system_message(model_name: str) -> SystemMessage:
+    """
+    Wraps SYSTEM_PROMPT in a SystemMessage, marking it as a cacheable prefix
+    for providers that need an explicit cache_control breakpoint.
+    """
+    if model_name.startswith(PROMPT_CACHE_CONTROL_PREFIXES):
+        return SystemMessage(content=[
+            {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+        ])
+    return SystemMessage(content=SYSTEM_PROMPT)
+
 class RAGPipeline:
     """
     A Retrieval-Augmented Generation (RAG) pipeline that:
@@ -66,9 +117,13 @@ class RAGPipeline:
     buffer : microsoft/mai-ds-r1:free
     """
 
-    def __init__(self, model_name: str = "microsoft/mai-ds-r1:free"):
+    def __init__(self, model_name: str = "microsoft/mai-ds-r1:free", vs: Optional[VectorStore] = None):
         """
         Initializes the LLM client and loads the vector store.
+
+        Args:
+            model_name (str): OpenRouter model id.
+            vs (VectorStore): Store to query; defaults to the shared process-wide store.
         """
         print("Initializing OpenRouterAI model...")
         api_key = os.getenv("OPENAI_API_KEY")
@@ -78,16 +133,27 @@ class RAGPipeline:
         os.environ["OPENAI_API_KEY"] = api_key
         os.environ["OPENAI_API_BASE"] = "https://openrouter.ai/api/v1"
 
+        self.model_name = model_name
         self.llm = ChatOpenAI(
             temperature=0.2,
             model_name=model_name,
         )
 
+        # Built once so every request sends a byte-identical prefix the provider can cache
+        self.system_message = build_system_message(model_name)
+
+        self.answer_cache = {}
+        # Requests read and write the caches from worker threads concurrently
+        self._cache_lock = threading.Lock()
+        if os.path.exists(ANSWER_CACHE_PATH):
+            self.answer_cache = load_packed(ANSWER_CACHE_PATH)
+
         print("Loading vector store...")
-        self.vs = VectorStore()
-        self.vs._load_or_initialize_index()
+        self.vs = vs or get_vector_store()
         print("Vector store loaded...")
 
+        self.semantic_cache = SemanticQueryCache(self.vs.index.d)
+
     def run(self, query: str, k: int = 5) -> dict:
         """
         Main RAG pipeline logic.
@@ -99,61 +165,127 @@ class RAGPipeline:
         Returns:
             dict: Contains final answer and source document IDs.
         """
+        cached, pending = self._prepare(query, k)
+        if cached is not None:
+            return cached
+
+        # Step 4: Generate answer
+        print("Asking LLM..")
+        response = self.llm.invoke(pending["messages"])
+        return self._complete(pending, response.content)
+
+    async def arun(self, query: str, k: int = 5) -> dict:
+        """
+        Async variant of `run` that awaits the LLM instead of blocking the event loop.
+        """
+        cached, pending = await asyncio.to_thread(self._prepare, query, k)
+        if cached is not None:
+            return cached
+
+        # Step 4: Generate answer
+        print("Asking LLM..")
+        response = await self.llm.ainvoke(pending["messages"])
+        # Caching the answer rewrites the cache files, so it runs off the event loop
+        return await asyncio.to_thread(self._complete, pending, response.content)
+
+    async def run_stream(self, query: str, k: int = 5) -> AsyncIterator[dict]:
+        """
+        Streaming variant of `run`: yields {"token": str} events as the LLM generates them,
+        then a final {"sources": [...]} event.
+        """
+        cached, pending = await asyncio.to_thread(self._prepare, query, k)
+        if cached is not None:
+            yield {"token": cached["answer"]}
+            yield {"sources": cached["source_files"]}
+            return
+
+        print("Streaming LLM answer..")
+        parts = []
+        async for chunk in self.llm.astream(pending["messages"]):
+            if chunk.content:
+                parts.append(chunk.content)
+                yield {"token": chunk.content}
+
+        result = await asyncio.to_thread(self._complete, pending, "".join(parts))
+        yield {"sources": result["source_files"]}
+
+    def _prepare(self, query: str, k: int) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Runs the cache lookups and retrieval, and builds the LLM prompt.
+
+        Returns:
+            (cached_result, None) on a cache hit, otherwise (None, pending) where
+            pending holds the prompt messages and what `_complete` needs to cache the answer.
+        """
+        # Pick up re-ingests done by other requests or workers since this pipeline was built
+        self.vs.reload_if_stale()
+
+        # The store generation is part of both cache keys so answers go stale once docs are
+        # ingested or removed.
+        scope = f"{self.model_name}|{self.vs.generation}|{k}"
+        cache_key = hashlib.sha256(f"{scope}|{query}".encode("utf-8")).hexdigest()
+        with self._cache_lock:
+            cached = self.answer_cache.get(cache_key)
+        if cached is not None:
+            print("Answer cache hit.")
+            return cached, None
+
         print("Querying docs...")
         # Step 1: Retrieve top-k documents
-        docs = self.vs.search(query, k=k)
+        query_vec = self.vs.embed_query(query)
+        # MMR drops near-duplicate passages so the context isn't padded with repeats
+        docs = self.vs.search_mmr(query_vec, k=k)
+        doc_ids = [doc["doc_id"] for doc in docs]
+
+        cached = self.semantic_cache.lookup(query_vec, doc_ids, scope)
+        if cached is not None:
+            print("Semantic cache hit.")
+            self._cache_answer(cache_key, cached)
+            return cached, None
 
         print("Creating context..")
 
         # Step 2: Format context
-        context = "\n".join([f"[{i+1}] {doc['content']}" for i, doc in enumerate(docs)])
+        # Only the chunks that matched go into the prompt, not whole documents
+        context = "\n".join([f"[{i+1}] {' ... '.join(doc['chunks'])}" for i, doc in enumerate(docs)])
 
         print("Creating messages...")
 
         # Step 3: Construct prompt
         messages = [
-            SystemMessage(
-                content=(
-                    """
-                    You are a helpful assistant who understands the Godspeed Framework deeply. Always aim to provide technically sound, creative, and helpful answers to a wide range of user questions, using the documentation provided as context.
-
-**Rules:**
-1. Always read and understand the full user query and provided context before answering.
-   - If the answer can be fully derived from the context, then answer with thorough technical clarity using at least 1000 tokens when needed.
-   - If the answer cannot be fully derived from context, say so sincerely — unless you can add well-grounded insights from general training that logically extend the documentation.
-
-2. Be versatile:
-   - Explain concepts clearly when asked for definitions or meanings.
-   - Describe how components work when asked about mechanisms.
-   - Show how to build new things using given APIs or tools when asked for implementation help.
-
-3. Respond naturally and warmly if the user is just chatting.
-
-4. When including Bash commands:
-   - Format using fenced bash blocks:
-     ```bash
-     # example
-     godspeed run app.yaml
-     ```
-
-5. When using math or formulas:
-   - Always use inline LaTeX: wrap expressions like this — `$a^2 + b^2 = c^2$`.
-   - Use `$$` for display math on its own line, and always close math blocks properly.
-
-Your tone should be friendly but focused. If the user asks something unrelated to the documentation or framework, explain clearly that you are focused on helping with Godspeed-related tasks.
-                    """
-                )
-            ),
+            self.system_message,
             HumanMessage(
                 content=f"Context:\n{context}\n\nQuestion: {query}\nAnswer:"
             )
         ]
 
-        # Step 4: Generate answer
-        print("Asking LLM..")
-        response = self.llm.invoke(messages)
+        return None, {
+            "messages": messages,
+            "cache_key": cache_key,
+            "scope": scope,
+            "query_vec": query_vec,
+            "doc_ids": doc_ids
+        }
 
-        return {
-            "answer": response.content.strip(),
-            "source_files": list({doc["doc_id"] for doc in docs})
+    def _complete(self, pending: dict, answer: str) -> dict:
+        """
+        Packages the LLM answer and stores it in both caches.
+        """
+        result = {
+            "answer": answer.strip(),
+            "source_files": pending["doc_ids"]
         }
+        self.semantic_cache.add(pending["query_vec"], result, pending["doc_ids"], pending["scope"])
+        self._cache_answer(pending["cache_key"], result)
+        return result
+
+    def _cache_answer(self, cache_key: str, result: dict):
+        """
+        Stores an answer in the exact-match cache and persists it to disk.
+        """
+        with self._cache_lock:
+            self.answer_cache[cache_key] = result
+            # Dicts keep insertion order, so the first keys are the oldest answers
+            for stale_key in list(self.answer_cache)[:-ANSWER_CACHE_MAX_ENTRIES]:
+                del self.answer_cache[stale_key]
+            save_packed(self.answer_cache, ANSWER_CACHE_PATH)
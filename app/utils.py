@@ -1,47 +1,154 @@
 
 from pathlib import Path
 import fitz  # PyMuPDF
-from PIL import Image
-import pytesseract
-import io
-from typing import List, Tuple
+import os
+import re
+import mmap
+import sqlite3
+import hashlib
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
+import zstandard as zstd
+from typing import Any, List, Tuple
 
-# Set path to Tesseract OCR executable (required for Windows systems)
-pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
+# Max Tesseract processes running at once while OCR-ing the pages of one PDF, unless the caller
+# passes a smaller share (e.g. when several PDFs are extracted in parallel)
+OCR_WORKERS = os.cpu_count() or 1
+# Render resolution for OCR; Tesseract accuracy barely improves above ~150 DPI while cost grows with pixel count
+OCR_DPI = 200
+# OCR output keyed by sha256 of the rendered page / image pixels, so unchanged pages skip Tesseract on re-ingest
+OCR_CACHE_DB = "index/ocr_cache.db"
+# Text extracted from PDFs/images, keyed by sha256 of the file, so unchanged files skip extraction entirely
+TEXT_CACHE_DB = "index/text_cache.db"
+# Files whose text comes from PDF parsing or OCR rather than a plain read
+EXTRACTED_EXTS = {".pdf", ".png", ".jpg", ".jpeg"}
+# Concurrent plain-text file reads in load_text_files_from_dir
+READ_WORKERS = 32
+# Files larger than this are hashed through a memory map instead of being read into memory
+MMAP_HASH_MIN_BYTES = 1 << 20
+# Read size when hashing smaller files on Python < 3.11
+HASH_BLOCK_BYTES = 1 << 20
+
+
+def _tesseract():
+    """
+    Imports pytesseract on first OCR use, so text-only ingests never pay for loading it.
+    """
+    import pytesseract
+    # Pages are already OCR'd in parallel, so each tesseract process sticks to one OpenMP thread
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    # Set path to Tesseract OCR executable (required for Windows systems)
+    pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
+    return pytesseract
+
+def _open_ocr_cache() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(OCR_CACHE_DB), exist_ok=True)
+    # Several ingest worker processes may write at once
+    db = sqlite3.connect(OCR_CACHE_DB, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS ocr_cache (hash TEXT PRIMARY KEY, text TEXT)")
+    return db
+
+def file_hash(file_path: str) -> str:
+    """
+    Computes the SHA-256 hash of a file's contents in C, without a Python read loop.
+
+    Args:
+    - file_path: Path to the file.
+
+    Returns:
+    - SHA-256 hex digest of the file.
+    """
+    # Unbuffered: every read goes straight into hashlib's buffer, no intermediate copy
+    with open(file_path, "rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size > MMAP_HASH_MIN_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest()
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        buf = memoryview(bytearray(HASH_BLOCK_BYTES))
+        while n := f.readinto(buf):
+            digest.update(buf[:n])
+        return digest.hexdigest()
+
+def _pixels_hash(width: int, height: int, mode, samples: bytes) -> str:
+    return hashlib.sha256(f"{width}x{height}:{mode}\n".encode("utf-8") + samples).hexdigest()
 
 
 def hybrid_pdf_extraction(doc,
         # pdf_path: str ,
-          ocr_threshold: int = 30) -> str:
+          ocr_threshold: int = 30,
+          ocr_workers: int = OCR_WORKERS) -> str:
     """
     Extracts text from PDFs using direct text extraction first. Falls back to OCR if not enough text is found.
     
     Args:
     - pdf_path: Path to the PDF file.
     - ocr_threshold: Minimum text length to accept before triggering OCR.
+    - ocr_workers: Max pages OCR'd at once.
 
     Returns:
     - Combined text extracted using both methods.
     """
     # doc = fitz.open(pdf_path)
-    complete_text = ""
-
+    page_texts = []
+    ocr_pages = []
     for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text = page.get_text().strip()
-        
-
+        text = doc.load_page(page_num).get_text().strip()
         if text and len(text) >= ocr_threshold:
-            complete_text += text
+            page_texts.append(text)
         else:
-            pix = page.get_pixmap(dpi=300)
-            img = Image.open(io.BytesIO(pix.tobytes("png")))
-            ocr_text = pytesseract.image_to_string(img).strip()
-            if ocr_text:
-                complete_text += ocr_text
+            page_texts.append(None)
+            ocr_pages.append(page_num)
+
+    # Text-only PDFs never touch the renderer, the OCR cache or Tesseract
+    if not ocr_pages:
+        return "".join(page_texts)
+
+    from PIL import Image
+
+    # Pages are rendered here (PyMuPDF isn't thread-safe) and OCR'd concurrently. pytesseract waits
+    # on a tesseract subprocess, so threads are enough to keep several pages in flight.
+    new_ocr = {}
+    with closing(_open_ocr_cache()) as cache, ThreadPoolExecutor(max_workers=ocr_workers) as executor:
+        for page_num in ocr_pages:
+            pix = doc.load_page(page_num).get_pixmap(dpi=OCR_DPI)
+            key = _pixels_hash(pix.width, pix.height, pix.n, pix.samples)
+            row = cache.execute("SELECT text FROM ocr_cache WHERE hash = ?", (key,)).fetchone()
+            if row:
+                page_texts[page_num] = row[0]
+            else:
+                # Identical pages (e.g. blank ones) share one OCR run
+                if key not in new_ocr:
+                    # Built straight from the raw samples; no PNG encode/decode round trip
+                    img = Image.frombytes("RGBA" if pix.alpha else "RGB", (pix.width, pix.height), pix.samples)
+                    new_ocr[key] = executor.submit(_ocr_image, img)
+                page_texts[page_num] = new_ocr[key]
 
+        complete_text = "".join(text if isinstance(text, str) else text.result() for text in page_texts)
+        if new_ocr:
+            with cache:
+                cache.executemany(
+                    "INSERT OR REPLACE INTO ocr_cache (hash, text) VALUES (?, ?)",
+                    [(key, future.result()) for key, future in new_ocr.items()]
+                )
     return complete_text
 
+def _ocr_image(img) -> str:
+    """
+    Runs OCR on a rendered page image.
+    """
+    return _tesseract().image_to_string(img).strip()
+
+def extract_pdf_bytes(content: bytes, ocr_workers: int = OCR_WORKERS) -> str:
+    """
+    Opens an in-memory PDF and runs `hybrid_pdf_extraction` on it.
+    Takes raw bytes so it can be shipped to a worker process.
+    """
+    with fitz.open(stream=content, filetype="pdf") as doc:
+        return hybrid_pdf_extraction(doc, ocr_workers=ocr_workers)
+
 def chunk_text(text: str, max_tokens: int = 500, overlap: int = 100) -> List[str]:
     """
     Splits long text into overlapping chunks for embedding.
@@ -54,16 +161,13 @@ def chunk_text(text: str, max_tokens: int = 500, overlap: int = 100) -> List[str
     Returns:
     - A list of text chunks.
     """
-    words = text.split()
-    chunks = []
-    start = 0
-
-    while start < len(words):
-        end = start + max_tokens
-        chunks.append(" ".join(words[start:end]))
-        start += max_tokens - overlap
-
-    return chunks
+    # Word boundaries are found in one pass and each chunk is a single slice of the original text,
+    # instead of re-joining its words (this also keeps the text's own line breaks and indentation).
+    spans = [m.span() for m in re.finditer(r"\S+", text)]
+    return [
+        text[spans[start][0]:spans[min(start + max_tokens, len(spans)) - 1][1]]
+        for start in range(0, len(spans), max_tokens - overlap)
+    ]
 
 def extract_text_from_image(img
                             # ,path: str
@@ -79,11 +183,49 @@ def extract_text_from_image(img
     """
     try:
         # img = Image.open(path)
-        return pytesseract.image_to_string(img)
+        if isinstance(img, (str, Path)):
+            key = hashlib.sha256(Path(img).read_bytes()).hexdigest()
+        else:
+            key = _pixels_hash(img.width, img.height, img.mode, img.tobytes())
+        with closing(_open_ocr_cache()) as cache:
+            row = cache.execute("SELECT text FROM ocr_cache WHERE hash = ?", (key,)).fetchone()
+            if row:
+                return row[0]
+            text = _tesseract().image_to_string(img)
+            with cache:
+                cache.execute("INSERT OR REPLACE INTO ocr_cache (hash, text) VALUES (?, ?)", (key, text))
+            return text
     except Exception as e:
         print(f"Failed to process image {img}: {e}")
         return ""
 
+def _extract_file_text(filepath: Path, ext: str) -> str:
+    """
+    Extracts the text of one file. PDF and image results are cached by file hash,
+    so re-ingesting an unchanged file doesn't re-run PDF parsing or OCR.
+    """
+    if ext not in EXTRACTED_EXTS:
+        return filepath.read_text(encoding="utf-8", errors="ignore")
+
+    key = f"{ext}:{file_hash(str(filepath))}"
+    os.makedirs(os.path.dirname(TEXT_CACHE_DB), exist_ok=True)
+    with closing(sqlite3.connect(TEXT_CACHE_DB, timeout=30)) as cache:
+        cache.execute("CREATE TABLE IF NOT EXISTS text_cache (hash TEXT PRIMARY KEY, text TEXT)")
+        row = cache.execute("SELECT text FROM text_cache WHERE hash = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+
+        if ext == ".pdf":
+            with fitz.open(str(filepath)) as doc:
+                text = hybrid_pdf_extraction(doc)
+        else:
+            ocr_text = extract_text_from_image(str(filepath))
+            text = f"[OCR]\n{ocr_text.strip()}"
+
+        with cache:
+            cache.execute("INSERT OR REPLACE INTO text_cache (hash, text) VALUES (?, ?)", (key, text))
+        return text
+
 def load_text_files_from_dir(
     dir_path: str, 
     allowed_exts={".md", ".txt", ".json", ".pdf"}
@@ -98,26 +240,31 @@ def load_text_files_from_dir(
     Returns:
     - List of (file_path, extracted_text) tuples.
     """
-    docs = []
-    for filepath in Path(dir_path).rglob("*"):
-        ext = filepath.suffix.lower()
-        if ext in allowed_exts and filepath.is_file():
-            try:
-                if ext == ".pdf":
-                    text = hybrid_pdf_extraction(str(filepath))
-                elif ext in {".png", ".jpg", ".jpeg"}:
-                    ocr_text = extract_text_from_image(str(filepath))
-                    text = f"[OCR]\n{ocr_text.strip()}"
-                else:
-                    text = filepath.read_text(encoding="utf-8", errors="ignore")
-
-                if text.strip():
-                    docs.append((str(filepath), text))
-
-            except Exception as e:
-                print(f"Failed to read {filepath}: {e}")
+    filepaths = [
+        filepath for filepath in Path(dir_path).rglob("*")
+        if filepath.suffix.lower() in allowed_exts and filepath.is_file()
+    ]
 
-    return docs
+    def extract(filepath: Path):
+        try:
+            return _extract_file_text(filepath, filepath.suffix.lower())
+        except Exception as e:
+            print(f"Failed to read {filepath}: {e}")
+            return ""
+
+    # Plain-text reads are I/O-bound and run concurrently to keep the disk queue full.
+    # PDFs and images stay on this thread: PyMuPDF isn't thread-safe and OCR is already parallel.
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        texts = [
+            executor.submit(extract, filepath) if filepath.suffix.lower() not in EXTRACTED_EXTS else None
+            for filepath in filepaths
+        ]
+        texts = [
+            extract(filepath) if text is None else text.result()
+            for filepath, text in zip(filepaths, texts)
+        ]
+
+    return [(str(filepath), text) for filepath, text in zip(filepaths, texts) if text.strip()]
 
 def load_files_from_file_path(
     file_path: str,
@@ -139,13 +286,7 @@ def load_files_from_file_path(
 
     if ext in allowed_exts and filepath.is_file():
         try:
-            if ext == ".pdf":
-                text = hybrid_pdf_extraction(str(filepath))
-            elif ext in {".png", ".jpg", ".jpeg"}:
-                ocr_text = extract_text_from_image(str(filepath))
-                text = f"[OCR]\n{ocr_text.strip()}"
-            else:
-                text = filepath.read_text(encoding="utf-8", errors="ignore")
+            text = _extract_file_text(filepath, ext)
 
             if text.strip():
                 docs.append((str(filepath), text))
@@ -155,4 +296,20 @@ def load_files_from_file_path(
 
     return docs
 
+def save_packed(obj: Any, path: str):
+    """
+    Writes an object to disk as zstd-compressed msgpack.
+
+    Args:
+    - obj: Plain data (dicts, lists, str, bytes, numbers).
+    - path: Destination file.
+    """
+    with open(path, "wb") as f:
+        f.write(zstd.ZstdCompressor(level=3).compress(msgpack.packb(obj, use_bin_type=True)))
 
+def load_packed(path: str) -> Any:
+    """
+    Reads an object written by `save_packed`.
+    """
+    with open(path, "rb") as f:
+        return msgpack.unpackb(zstd.ZstdDecompressor().decompress(f.read()), raw=False)
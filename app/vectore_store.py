@@ -1,12 +1,24 @@
 """
-VectorStore class using FAISS (IndexFlatL2 + IndexIDMap) and LangChain GoogleGenerativeAIEmbeddings.
-Supports efficient upsertion and retrieval of small to medium document collections.
+VectorStore class using FAISS (8-bit IndexHNSWSQ + IndexIDMap) and LangChain GoogleGenerativeAIEmbeddings.
+Supports efficient upsertion and sub-linear retrieval over growing document collections.
 """
 
 import faiss
 import pickle
 import os
+import json
+import sqlite3
 import hashlib
+import functools
+import threading
+import atexit
+import weakref
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process index lock, so run a single ingesting worker there
+    fcntl = None
 from pathlib import Path
 from typing import List, Tuple, Dict
 # from sentence_transformers import SentenceTransformer
@@ -14,148 +26,723 @@ import numpy as np
 
 from dotenv import load_dotenv
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from app.utils import chunk_text
+from app.utils import chunk_text, file_hash
+from app.embeddings import OnnxEmbeddings
 
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
+# HNSW graph parameters: neighbours per node and build-time search depth.
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+# Vector encoding for new indexes (FAISS_SQ_TYPE): "int8" codes take 1 byte/dim instead of 4,
+# "fp16" takes 2 bytes/dim but needs no training and loses almost no precision.
+SQ_TYPES = {
+    "int8": faiss.ScalarQuantizer.QT_8bit_uniform,
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+}
+SQ_TYPE = os.getenv("FAISS_SQ_TYPE", "int8")
+# The int8 quantizer range is learned from the first batch and widened by this fraction
+# so later vectors aren't clipped.
+SQ_RANGE_SLACK = 0.1
+# flush() rebuilds the HNSW index once more than this fraction of its vectors are no
+# longer referenced by any document (HNSW can't delete vectors in place)
+COMPACT_DEAD_FRACTION = 0.2
+# search() pulls k * SEARCH_OVERFETCH chunk hits to collect k distinct documents
+SEARCH_OVERFETCH = 4
+# search_mmr() reranks this many candidate documents, trading relevance (weight MMR_LAMBDA)
+# against similarity to documents already picked
+MMR_FETCH_K = 25
+MMR_LAMBDA = 0.7
+# Max "?" placeholders per SQLite IN (...) query
+SQLITE_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id TEXT PRIMARY KEY,
+    content_hash TEXT,
+    content TEXT,
+    chunks TEXT
+);
+CREATE TABLE IF NOT EXISTS fid_docs (
+    fid INTEGER NOT NULL,
+    doc_id TEXT NOT NULL,
+    PRIMARY KEY (fid, doc_id)
+);
+CREATE INDEX IF NOT EXISTS fid_docs_doc_id ON fid_docs (doc_id);
+CREATE TABLE IF NOT EXISTS chunk_fids (
+    hash TEXT PRIMARY KEY,
+    fid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_fids_fid ON chunk_fids (fid);
+CREATE TABLE IF NOT EXISTS chunk_texts (
+    fid INTEGER PRIMARY KEY,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS chunk_embeddings (
+    hash TEXT PRIMARY KEY,
+    embedding BLOB
+);
+"""
+
+def _synchronized(method):
+    """Runs a VectorStore method under the store's lock; FAISS indexes aren't safe to search while being modified."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _flush_at_exit(store_ref: "weakref.ref[VectorStore]"):
+    store = store_ref()
+    if store is not None:
+        store.flush()
+
+
+@functools.lru_cache(maxsize=1)
+def get_vector_store() -> "VectorStore":
+    """
+    Returns the process-wide VectorStore, so the embedding client and FAISS index are loaded once
+    and shared by querying and ingestion.
+    """
+    return VectorStore()
+
+
 class VectorStore:
+    # Embedding clients by model_key, loaded on first use and shared by every VectorStore in the process
+    _models: Dict[str, object] = {}
+    _models_lock = threading.Lock()
+
+    @classmethod
+    def _get_model(cls, model_key: str, load):
+        """Returns the shared embedding client for model_key, calling load() the first time."""
+        with cls._models_lock:
+            if model_key not in cls._models:
+                print("Loading embedding model...")
+                cls._models[model_key] = load()
+                print("Embedding model loaded.")
+            return cls._models[model_key]
+
     def __init__(
         self,
         index_path="index/index.faiss",
-        meta_path="index/metadata.pkl"
+        meta_path="index/metadata.db",
+        legacy_meta_path="index/metadata.pkl"
     ):
 
         print("VectorStore: Initializing...")
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-           raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
-        os.environ["GOOGLE_API_KEY"] = api_key
-
+        # Checked here because errors raised while loading the index are only logged
+        if SQ_TYPE not in SQ_TYPES:
+            raise ValueError(f"FAISS_SQ_TYPE must be one of {sorted(SQ_TYPES)}, got {SQ_TYPE!r}")
         self.index_path = index_path
         self.meta_path = meta_path
-        print("Loading embedding model...")
-        # self.model = SentenceTransformer("BAAI/bge-large-en-v1.5")
-        self.model = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-        print("Embedding model loaded.")
+        self.legacy_meta_path = legacy_meta_path
+
+        backend = os.getenv("EMBEDDING_BACKEND", "google")
+        if backend == "onnx":
+            onnx_dir = os.getenv("EMBEDDING_ONNX_DIR", "bge-onnx-int8")
+            onnx_file = os.getenv("EMBEDDING_ONNX_FILE", "model_quantized.onnx")
+            self.model_key = f"onnx:{onnx_dir}/{onnx_file}"
+            self.model = self._get_model(self.model_key, lambda: OnnxEmbeddings(onnx_dir, file_name=onnx_file))
+        else:
+            api_key = os.getenv("GOOGLE_API_KEY")
+            if not api_key:
+               raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
+            os.environ["GOOGLE_API_KEY"] = api_key
+            # self.model = SentenceTransformer("BAAI/bge-large-en-v1.5")
+            self.model_key = "google:models/embedding-001"
+            self.model = self._get_model(self.model_key, lambda: GoogleGenerativeAIEmbeddings(model="models/embedding-001"))
 
         self.index = None
-        self.metadata: Dict[str, dict] = {}
-        self.doc_id_by_faiss_id: Dict[int, str] = {}
+        # mtime of the index file the in-memory index was loaded from
+        self._index_mtime = None
+        # Set when the index or metadata changed since the last flush()
+        self._dirty = False
+        # Array form of fid_docs used by search; rebuilt lazily after metadata changes
+        self._fid_lookup = None
+        self._lock = threading.RLock()
+        # Cross-process writer lock (see _writer_lock); the file is held open while locked
+        self._writer_file = None
+        self._writer_depth = 0
+        # Batched searches split query rows across OpenMP threads; cap them when several
+        # workers share the machine
+        if os.getenv("FAISS_OMP_THREADS"):
+            faiss.omp_set_num_threads(int(os.getenv("FAISS_OMP_THREADS")))
+
+        # Metadata rows are written incrementally; to_thread callers may use it from any thread
+        self.db = sqlite3.connect(self.meta_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._migrate_faiss_ids_table()
 
         self._load_or_initialize_index()
+        # Removals that were never flushed still reach disk on shutdown
+        atexit.register(_flush_at_exit, weakref.ref(self))
 
     def _load_or_initialize_index(self):
      try:
+        # Metadata stays in SQLite and is read per lookup, so nothing else is loaded up front.
+        # Imported first: migrating a flat index flushes, and flush() compacts away any vector
+        # that fid_docs doesn't reference yet.
+        self._migrate_legacy_metadata()
+
         if os.path.exists(self.index_path):
             print("Loading existing FAISS index...")
             self.index = faiss.read_index(self.index_path)
+            self._index_mtime = os.path.getmtime(self.index_path)
+            if self._hnsw_index() is None:
+                self._migrate_flat_index()
         else:
             print("Creating new FAISS index...")
             sample_vec = self.model.embed_documents(["sample"]
                                                     # , convert_to_numpy=True
                                                     )
-            dim = len(sample_vec[0])
-            self.index = faiss.IndexIDMap(faiss.IndexFlatL2(dim))
-
-        if os.path.exists(self.meta_path):
-            print("Loading metadata...")
-            with open(self.meta_path, "rb") as f:
-                data = pickle.load(f)
-                self.metadata = data.get("metadata", {})
-                self.doc_id_by_faiss_id = data.get("faiss_id_map", {})
+            self.index = self._new_index(len(sample_vec[0]))
 
      except Exception as e:
         print(f"[ERROR] Failed to initialize FAISS index: {e}")
 
 
-    # def get_file_hash(self, file_path: str) -> str:
-    #     sha256_hash = hashlib.sha256()
-    #     with open(file_path, "rb") as f:
-    #         for block in iter(lambda: f.read(4096), b""):
-    #             sha256_hash.update(block)
-    #     return sha256_hash.hexdigest()
-
-    def _generate_faiss_ids(self, count: int) -> List[int]:
-        base = self.index.ntotal
-        return list(range(base, base + count))
-
-    def upsert(self, doc_id: str, 
-            #    file_path: str,
-                 content: str):
-        # content_hash = self.get_file_hash(file_path)
-
-        # if doc_id in self.metadata and self.metadata[doc_id]["content_hash"] == content_hash:
-        #     print(f"[{doc_id}] Skipping: No changes.")
-        #     return
-        # elif doc_id in self.metadata:
-        #     print(f"[{doc_id}] Updating existing document...")
-        # else:
-        #     print(f"[{doc_id}] Adding new document...")
-        # print(content)
-        chunks = chunk_text(content)
-        embeddings = self.model.embed_documents(chunks
-                                                # , convert_to_numpy=True
-                                                )
-        faiss_ids = self._generate_faiss_ids(len(embeddings))
-        self.index.add_with_ids(np.array(embeddings, dtype="float32"), np.array(faiss_ids))
-        
-        for fid in faiss_ids:
-            self.doc_id_by_faiss_id[fid] = doc_id
-
-        self.metadata[doc_id] = {
-            # "content_hash": content_hash,
-            "content": content,
-            "chunks": chunks,
-            "faiss_ids": faiss_ids
-        }
-        # print(faiss_ids)
-        self.save()
-        print(f"[{doc_id}] Upsert complete.")
-
-    def upsert_documents(self, documents: List[Tuple[str, str]]):
-        for file_path, content in documents:
-            doc_id = file_path  # You can change this to any unique ID
-            self.upsert(doc_id, file_path, content)
+    def _new_index(self, dim: int, qtype=None):
+        """
+        Builds an empty HNSW index over SQ_TYPE-encoded vectors, wrapped to take our own ids.
+
+        Args:
+            qtype: faiss.ScalarQuantizer type to use instead of SQ_TYPE's.
+        """
+        if qtype is None:
+            qtype = SQ_TYPES[SQ_TYPE]
+        # Embeddings are L2-normalized, so inner product is cosine similarity
+        hnsw = faiss.IndexHNSWSQ(dim, qtype, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        faiss.downcast_index(hnsw.storage).sq.rangestat_arg = SQ_RANGE_SLACK
+        return faiss.IndexIDMap(hnsw)
+
+    def _migrate_flat_index(self):
+        """
+        One-time rebuild of a brute-force flat index written by older versions into HNSW,
+        keeping every vector's id so the metadata still lines up.
+        """
+        flat = faiss.downcast_index(self.index.index)
+        if not isinstance(flat, faiss.IndexFlat):
+            return
+        print(f"Migrating flat FAISS index ({flat.ntotal} vectors) to HNSW...")
+        index = self._new_index(flat.d)
+        if flat.ntotal:
+            vectors = flat.reconstruct_n(0, flat.ntotal)
+            faiss.normalize_L2(vectors)
+            index.train(vectors)
+            index.add_with_ids(vectors, faiss.vector_to_array(self.index.id_map).astype("int64"))
+
+        # Every vector a document points at must have survived; the flat index on disk is
+        # left untouched if not
+        mapped = {fid for (fid,) in self.db.execute("SELECT DISTINCT fid FROM fid_docs")}
+        missing = mapped - set(faiss.vector_to_array(index.id_map).tolist())
+        if missing:
+            raise RuntimeError(f"Flat index migration lost {len(missing)} of {len(mapped)} referenced vectors")
+        self.index = index
+        self._dirty = True
+        self.flush()
+
+    def _migrate_faiss_ids_table(self):
+        """
+        One-time move of the fid -> doc_id rows from the old faiss_ids table, which allowed only
+        one document per vector, into fid_docs.
+        """
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'faiss_ids'").fetchone():
+            return
+        print("Migrating faiss_ids to fid_docs...")
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO fid_docs (fid, doc_id) SELECT fid, doc_id FROM faiss_ids")
+            self.db.execute("DROP TABLE faiss_ids")
+
+    def _migrate_legacy_metadata(self):
+        """
+        One-time import of the pickled metadata written by older versions into SQLite.
+        """
+        if not os.path.exists(self.legacy_meta_path):
+            return
+        if self.db.execute("SELECT 1 FROM docs LIMIT 1").fetchone():
+            return
+
+        print("Migrating pickled metadata to SQLite...")
+        with open(self.legacy_meta_path, "rb") as f:
+            data = pickle.load(f)
+        for doc_id, meta in data.get("metadata", {}).items():
+            self._write_doc(doc_id, meta.get("content_hash"), meta["content"], meta["chunks"], meta["faiss_ids"])
+        self.db.commit()
+        # Renamed so an emptied docs table later doesn't pull the stale pickle back in
+        os.replace(self.legacy_meta_path, self.legacy_meta_path + ".migrated")
+
+    @_synchronized
+    def reload_if_stale(self):
+        """
+        Re-reads the FAISS index if another VectorStore (e.g. an ingest run) has rewritten it.
+        Metadata needs no reload since it is always read from SQLite.
+        """
+        if os.path.exists(self.index_path) and os.path.getmtime(self.index_path) != self._index_mtime:
+            print("Index changed on disk. Reloading FAISS index...")
+            self.index = faiss.read_index(self.index_path)
+            self._index_mtime = os.path.getmtime(self.index_path)
+            # Whoever rewrote the index also changed the metadata
+            self._fid_lookup = None
+
+    @property
+    def generation(self):
+        """
+        Identifies the flushed state of the store: changes with every flush that wrote an added,
+        updated or removed document, including flushes by other processes once reloaded.
+        Unlike index.ntotal it also changes when vectors are only unmapped or shared.
+        """
+        return self._index_mtime
+
+    def _select_in(self, query: str, values: list) -> list:
+        """Runs `query` (containing a single "IN ({})") over `values` in SQLite-sized batches."""
+        rows = []
+        for i in range(0, len(values), SQLITE_BATCH):
+            batch = values[i:i + SQLITE_BATCH]
+            rows.extend(self.db.execute(query.format(",".join("?" * len(batch))), batch))
+        return rows
+
+    def _write_doc(self, doc_id: str, content_hash: str, content: str, chunks: List[str], faiss_ids: List[int]):
+        """Writes a document's rows; faiss_ids[i] is the vector holding chunks[i]."""
+        self._fid_lookup = None
+        self.db.execute(
+            "INSERT OR REPLACE INTO docs (doc_id, content_hash, content, chunks) VALUES (?, ?, ?, ?)",
+            (doc_id, content_hash, content, json.dumps(chunks))
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO fid_docs (fid, doc_id) VALUES (?, ?)",
+            [(fid, doc_id) for fid in faiss_ids]
+        )
+        # Shared vectors keep the hash and text they were first written with
+        self.db.executemany(
+            "INSERT OR IGNORE INTO chunk_fids (hash, fid) VALUES (?, ?)",
+            [(self._chunk_hash(chunk), fid) for chunk, fid in zip(chunks, faiss_ids)]
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO chunk_texts (fid, text) VALUES (?, ?)",
+            list(zip(faiss_ids, chunks))
+        )
+
+    def _fid_lookup_arrays(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """
+        Structure-of-arrays view of fid_docs: the documents holding vector `fid` are
+        doc_ids[i] for i in doc_idx[offsets[fid]:offsets[fid + 1]]. Lets search map hits to
+        documents by array indexing instead of a SQL lookup per query.
+        """
+        if self._fid_lookup is None:
+            rows = self.db.execute("SELECT fid, doc_id FROM fid_docs ORDER BY fid").fetchall()
+            doc_ids = sorted({doc_id for _, doc_id in rows})
+            position = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+            fids = np.fromiter((fid for fid, _ in rows), dtype="int64", count=len(rows))
+            doc_idx = np.fromiter((position[doc_id] for _, doc_id in rows), dtype="int32", count=len(rows))
+            # CSR offsets: vector fid owns rows offsets[fid]:offsets[fid + 1]
+            counts = np.bincount(fids + 1, minlength=int(fids[-1]) + 2 if len(fids) else 1)
+            self._fid_lookup = (np.cumsum(counts), doc_idx, doc_ids)
+        return self._fid_lookup
+
+    def get_file_hash(self, file_path: str) -> str:
+        """
+        Compute the SHA-256 hash of a file's contents in C, without a Python read loop.
+
+        Args:
+            file_path (str): Absolute or relative path to the file.
+
+        Returns:
+            str: SHA-256 hex digest of the file.
+        """
+        return file_hash(file_path)
+
+    def _hnsw_index(self):
+        """Returns the HNSW index wrapped by the id map, or None for legacy flat indexes."""
+        inner = faiss.downcast_index(self.index.index)
+        return inner if isinstance(inner, faiss.IndexHNSW) else None
+
+    def _embed_chunks(self, chunks: List[str], hashes: List[str]) -> np.ndarray:
+        """
+        Embeds chunks, reusing cached embeddings for any chunk text seen before.
+
+        Args:
+            chunks (List[str]): Chunk texts to embed.
+            hashes (List[str]): `_chunk_hash` of each chunk.
+
+        Returns:
+            np.ndarray: L2-normalized float32 matrix with one row per chunk, in input order.
+        """
+        if not chunks:
+            return np.empty((0, self.index.d), dtype="float32")
+
+        with self._lock:
+            cached = self._get_cached_embeddings(set(hashes))
+        missing = {h: chunk for h, chunk in zip(hashes, chunks) if h not in cached}
+        if missing:
+            # The embedding call is slow, so searches aren't held up while it runs
+            new_embs = self.model.embed_documents(list(missing.values()))
+            for h, emb in zip(missing, new_embs):
+                cached[h] = np.asarray(emb, dtype="float32")
+            with self._lock:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO chunk_embeddings (hash, embedding) VALUES (?, ?)",
+                    [(h, cached[h].tobytes()) for h in missing]
+                )
+                # Committed now so no SQLite write transaction stays open outside _writer_lock
+                self.db.commit()
+        print(f"Embedded {len(missing)} new chunks, reused {len(chunks) - len(missing)} cached.")
+        embeddings = np.vstack([cached[h] for h in hashes])
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def _chunk_hash(self, chunk: str) -> str:
+        # Keyed per model so switching backends never reuses another model's vectors
+        return hashlib.sha256(f"{self.model_key}\n{chunk}".encode("utf-8")).hexdigest()
+
+    def _get_cached_embeddings(self, hashes: set) -> Dict[str, np.ndarray]:
+        """Looks up previously computed chunk embeddings by sha256 of the chunk text."""
+        rows = self._select_in("SELECT hash, embedding FROM chunk_embeddings WHERE hash IN ({})", list(hashes))
+        return {h: np.frombuffer(blob, dtype="float32") for h, blob in rows}
+
+    def _generate_faiss_ids(self, count: int) -> np.ndarray:
+        """
+        Returns `count` new ids, starting after the largest id in the index. Basing them on ntotal
+        instead could hand out ids still in use once a flat index had vectors removed.
+        """
+        ids = faiss.vector_to_array(self.index.id_map)
+        base = int(ids.max()) + 1 if len(ids) else 0
+        return np.arange(base, base + count, dtype="int64")
+
+    def upsert(self, doc_id: str, content: str):
+        self.upsert_documents([(doc_id, content)])
+
+    @_synchronized
+    def get_content_hashes(self, doc_ids: List[str]) -> Dict[str, str]:
+        """
+        Returns the stored content hash of each indexed document among `doc_ids`.
+        Lets callers skip extracting files whose bytes haven't changed.
+        """
+        return dict(self._select_in("SELECT doc_id, content_hash FROM docs WHERE doc_id IN ({})", list(doc_ids)))
+
+    def upsert_documents(self, documents: List[tuple]):
+        """
+        Insert or update documents, embedding the chunks of all of them in one batched call.
+        Changes are flushed to disk once at the end.
+
+        Args:
+            documents (List[tuple]): (doc_id, content) pairs; doc_id is typically the file path.
+                A third item, if given, is used as the content hash instead of sha256(content)
+                (e.g. the hash of the raw file the text was extracted from).
+        """
+        # Another worker may have ingested since this index was loaded; writing on top of a
+        # stale copy would drop its vectors and reuse its ids
+        self.reload_if_stale()
+        stored_hashes = self.get_content_hashes([doc[0] for doc in documents])
+        pending = []
+        for doc_id, content, *known_hash in documents:
+            content_hash = known_hash[0] if known_hash else hashlib.sha256(content.encode("utf-8")).hexdigest()
+            if doc_id in stored_hashes:
+                if stored_hashes[doc_id] == content_hash:
+                    print(f"[{doc_id}] Skipping: No changes.")
+                    continue
+                print(f"[{doc_id}] Updating existing document...")
+            else:
+                print(f"[{doc_id}] Adding new document...")
+            pending.append((doc_id, content, content_hash, chunk_text(content)))
+
+        if not pending:
+            self.flush()
+            return
+
+        all_chunks = [chunk for *_, chunks in pending for chunk in chunks]
+        hashes = [self._chunk_hash(chunk) for chunk in all_chunks]
+        embeddings = self._embed_chunks(all_chunks, hashes)
+
+        # Old versions stay searchable until their replacements are embedded
+        with self._writer_lock():
+            # Pick up anything written while embedding, before ids are handed out
+            self.reload_if_stale()
+            if not self.index.is_trained and len(embeddings):
+                print("Training scalar quantizer on first batch...")
+                self.index.train(embeddings)
+
+            # Unlinked whether or not they existed before embedding, since another process may
+            # have added them meanwhile
+            old_fids = set()
+            for doc_id, *_ in pending:
+                old_fids.update(self._unlink(doc_id))
+
+            # Chunks already in the index (boilerplate, licenses, unchanged parts of an updated doc)
+            # share its vector; only the first copy of each new chunk is added.
+            fid_by_hash = dict(self._select_in("SELECT hash, fid FROM chunk_fids WHERE hash IN ({})", list(set(hashes))))
+            new_rows = {}
+            for row, h in enumerate(hashes):
+                if h not in fid_by_hash and h not in new_rows:
+                    new_rows[h] = row
+            print(f"Adding {len(new_rows)} new vectors, sharing {len(hashes) - len(new_rows)} duplicate chunks.")
+
+            # All new vectors go into the index in one call
+            faiss_ids = self._generate_faiss_ids(len(new_rows))
+            if len(faiss_ids):
+                self.index.add_with_ids(embeddings[list(new_rows.values())], faiss_ids)
+                fid_by_hash.update(zip(new_rows, faiss_ids.tolist()))
+
+            ends = np.cumsum([len(chunks) for *_, chunks in pending])
+            for (doc_id, content, content_hash, chunks), end in zip(pending, ends.tolist()):
+                doc_fids = [fid_by_hash[h] for h in hashes[end - len(chunks):end]]
+                self._write_doc(doc_id, content_hash, content, chunks, doc_fids)
+                print(f"[{doc_id}] Upsert complete.")
+
+            self._drop_orphaned_vectors(old_fids)
+            self._dirty = True
+
+            self.flush()
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Embeds a query as an L2-normalized (1, dim) float32 matrix ready for FAISS."""
+        query_vec = np.array([self.model.embed_query(query)], dtype="float32")
+        faiss.normalize_L2(query_vec)
+        return query_vec
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Embeds several queries in one model call as an L2-normalized (n, dim) float32 matrix."""
+        if isinstance(self.model, OnnxEmbeddings):
+            embeddings = self.model.embed_queries(queries)
+        else:
+            embeddings = self.model.embed_documents(queries, task_type="RETRIEVAL_QUERY")
+        query_vecs = np.array(embeddings, dtype="float32").reshape(len(queries), -1)
+        faiss.normalize_L2(query_vecs)
+        return query_vecs
 
     def search(self, query: str, k: int = 5) -> List[Dict[str, str]]:
-        query_vec = self.model.embed_query(query)
-        D, I = self.index.search(np.array([query_vec], dtype="float32"), k)
+        return self.search_by_vector(self.embed_query(query), k)
+
+    def search_many(self, queries: List[str], k: int = 5) -> List[List[Dict[str, str]]]:
+        """
+        Searches several queries (e.g. sub-queries of one question) with one embedding call
+        and one FAISS search.
+
+        Returns:
+            List[List[Dict[str, str]]]: One search_by_vector-style result list per query.
+        """
+        if not queries:
+            return []
+        return self.search_by_vectors(self.embed_queries(queries), k)
 
+    def search_by_vector(self, query_vec: np.ndarray, k: int = 5) -> List[Dict[str, str]]:
+        """
+        Returns up to k distinct documents, ranked by their best-matching chunk.
+
+        Returns:
+            List[Dict[str, str]]: {"doc_id", "chunks", "score"} per document, where "chunks" holds
+            only the document's chunks that matched (best first) rather than its full content,
+            and "score" is the best chunk's cosine similarity to the query.
+        """
+        return self.search_by_vectors(query_vec, k)[0]
+
+    @_synchronized
+    def search_by_vectors(self, query_vecs: np.ndarray, k: int = 5) -> List[List[Dict[str, str]]]:
+        """
+        Batched search_by_vector: one FAISS search over all rows of query_vecs, and one metadata
+        lookup for the hits of all of them.
+        """
+        if self.index.ntotal == 0:
+            return [[] for _ in range(len(query_vecs))]
+        # Several hits usually land in the same document (and removed HNSW vectors still
+        # match), so fetch extra chunks to still end up with k distinct documents.
+        n_hits = k * SEARCH_OVERFETCH
+        hnsw = self._hnsw_index()
+        if hnsw is not None:
+            hnsw.hnsw.efSearch = max(n_hits, 64)
+        D, I = self.index.search(query_vecs, n_hits)
+        if self.index.metric_type == faiss.METRIC_L2:
+            # Legacy flat indexes return squared L2 distances; for unit vectors cos = 1 - d / 2
+            D = 1 - D / 2
+
+        text_by_fid = dict(self._select_in(
+            "SELECT fid, text FROM chunk_texts WHERE fid IN ({})", np.unique(I[I != -1]).tolist()
+        ))
+        # A vector may be shared by several documents holding the same chunk
+        offsets, doc_idx, doc_ids = self._fid_lookup_arrays()
+        n_fids = len(offsets) - 1
+
+        # Removed vectors own no fid_docs rows (an empty offsets range) and are skipped here
         results = []
-        for idx in I[0]:
-            if idx == -1:
-                continue
-            doc_id = self.doc_id_by_faiss_id.get(idx)
-            if not doc_id or doc_id not in self.metadata:
-                continue
-            doc_meta = self.metadata[doc_id]
-            results.append({
-                "doc_id": doc_id,
-                "content": doc_meta["content"],
-                "chunks": doc_meta["chunks"]
-            })
+        for ids, dists in zip(I.tolist(), D.tolist()):
+            docs = {}
+            for idx, score in zip(ids, dists):
+                if not 0 <= idx < n_fids:
+                    continue
+                for i in doc_idx[offsets[idx]:offsets[idx + 1]].tolist():
+                    doc_id = doc_ids[i]
+                    if doc_id not in docs and len(docs) < k:
+                        docs[doc_id] = {"doc_id": doc_id, "chunks": [], "score": score}
+                    if doc_id in docs and idx in text_by_fid and text_by_fid[idx] not in docs[doc_id]["chunks"]:
+                        docs[doc_id]["chunks"].append(text_by_fid[idx])
+            results.append(list(docs.values()))
+
+        # Rows written before chunk texts were stored per vector fall back to the whole document
+        missing = list({doc["doc_id"] for docs in results for doc in docs if not doc["chunks"]})
+        if missing:
+            content = dict(self._select_in("SELECT doc_id, content FROM docs WHERE doc_id IN ({})", missing))
+            for doc in (doc for docs in results for doc in docs if not doc["chunks"]):
+                doc["chunks"] = [content.get(doc["doc_id"], "")]
         return results
 
-    def save(self):
-        faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, "wb") as f:
-            pickle.dump({
-                "metadata": self.metadata,
-                "faiss_id_map": self.doc_id_by_faiss_id
-            }, f)
+    @_synchronized
+    def search_mmr(
+        self,
+        query_vec: np.ndarray,
+        k: int = 5,
+        fetch_k: int = MMR_FETCH_K,
+        lambda_mult: float = MMR_LAMBDA
+    ) -> List[Dict[str, str]]:
+        """
+        Returns k relevant but mutually diverse documents using Maximal Marginal Relevance,
+        so near-duplicate passages don't crowd the LLM context.
 
-    def remove_document(self, doc_id: str):
-        if doc_id not in self.metadata:
-            print(f"[{doc_id}] Not found in index. Skipping removal.")
+        Args:
+            query_vec (np.ndarray): L2-normalized (1, dim) query embedding.
+            k (int): Number of documents to return.
+            fetch_k (int): Number of top documents to rerank.
+            lambda_mult (float): 1.0 ranks purely by relevance, 0.0 purely by diversity.
+
+        Returns:
+            List[Dict[str, str]]: Selected documents in pick order, same shape as search_by_vector.
+        """
+        candidates = self.search_by_vector(query_vec, max(k, fetch_k))
+        if len(candidates) <= k:
+            return candidates
+
+        # Each document is represented by its best-matching chunk, read from the embedding cache.
+        # Documents without cached embeddings (migrated from the pickle format) get no diversity penalty.
+        best_hashes = [self._chunk_hash(doc["chunks"][0]) for doc in candidates]
+        cached = self._get_cached_embeddings(set(best_hashes))
+        reps = np.vstack([cached.get(h, np.zeros(self.index.d, dtype="float32")) for h in best_hashes])
+        faiss.normalize_L2(reps)
+        pairwise = reps @ reps.T
+        relevance = np.array([doc["score"] for doc in candidates], dtype="float32")
+
+        selected = [0]
+        redundancy = pairwise[0].copy()
+        while len(selected) < k:
+            mmr = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            mmr[selected] = -np.inf
+            best = int(np.argmax(mmr))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, pairwise[best])
+        return [candidates[i] for i in selected]
+
+    @_synchronized
+    def flush(self):
+        """
+        Persists pending changes: commits the SQLite metadata rows and, if any vectors changed,
+        rewrites the FAISS index once for the whole batch.
+
+        Other workers reload when the index file changes, so the metadata is committed first
+        (a reload never sees an index newer than its metadata) and the index is swapped in with
+        an atomic rename (a reload never reads a half-written file).
+        """
+        with self._writer_lock():
+            self.db.commit()
+            if not self._dirty:
+                return
+            # Unflushed changes here are metadata-only (removals); vector additions flush under
+            # the same lock hold. So picking up another worker's newer index loses nothing.
+            self.reload_if_stale()
+            self._compact_if_needed()
+            tmp_path = self.index_path + ".tmp"
+            faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+            self._index_mtime = os.path.getmtime(self.index_path)
+            self._dirty = False
+
+    @contextlib.contextmanager
+    def _writer_lock(self):
+        """
+        Serializes index writers across processes (e.g. two uvicorn workers running /sync), so each
+        reloads, adds and flushes against the latest index.faiss instead of handing out the same ids
+        and overwriting the other's file. Also takes the in-process lock, and is reentrant.
+        """
+        with self._lock:
+            if self._writer_depth == 0 and fcntl is not None:
+                self._writer_file = open(self.index_path + ".lock", "a")
+                fcntl.flock(self._writer_file, fcntl.LOCK_EX)
+            self._writer_depth += 1
+            try:
+                yield
+            finally:
+                self._writer_depth -= 1
+                if self._writer_depth == 0 and self._writer_file is not None:
+                    fcntl.flock(self._writer_file, fcntl.LOCK_UN)
+                    self._writer_file.close()
+                    self._writer_file = None
+
+    def _compact_if_needed(self):
+        """
+        Rebuilds the HNSW index from its live vectors once too many are unreferenced, so
+        index.faiss stops growing and dead hits stop crowding out search results.
+        Vectors keep their ids, so the metadata needs no changes.
+        """
+        hnsw = self._hnsw_index()
+        if hnsw is None or hnsw.ntotal == 0:
             return
+        ids = faiss.vector_to_array(self.index.id_map)
+        live = np.array([fid for (fid,) in self.db.execute("SELECT DISTINCT fid FROM fid_docs")], dtype="int64")
+        keep = np.flatnonzero(np.isin(ids, live))
+        if len(ids) - len(keep) <= COMPACT_DEAD_FRACTION * len(ids):
+            return
+
+        print(f"Compacting FAISS index: keeping {len(keep)} of {len(ids)} vectors...")
+        old_sq = faiss.downcast_index(hnsw.storage).sq
+        index = self._new_index(hnsw.d, old_sq.qtype)
+        # Copy the trained quantizer so the decoded vectors re-encode to the same codes
+        new_hnsw = faiss.downcast_index(index.index)
+        new_storage = faiss.downcast_index(new_hnsw.storage)
+        new_storage.sq = old_sq
+        new_storage.is_trained = new_hnsw.is_trained = index.is_trained = hnsw.is_trained
+        if len(keep):
+            index.add_with_ids(hnsw.reconstruct_n(0, hnsw.ntotal)[keep], ids[keep])
+        self.index = index
 
-        faiss_ids = self.metadata[doc_id]["faiss_ids"]
-        self.index.remove_ids(np.array(faiss_ids, dtype="int64"))
-        for fid in faiss_ids:
-            self.doc_id_by_faiss_id.pop(fid, None)
-        self.metadata.pop(doc_id, None)
+    @_synchronized
+    def remove_document(self, doc_id: str):
+        """
+        Removes a document from the index. The metadata change is committed right away;
+        call flush() to persist the index.
+        """
+        with self._writer_lock():
+            self.reload_if_stale()
+            if not self.db.execute("SELECT 1 FROM docs WHERE doc_id = ?", (doc_id,)).fetchone():
+                print(f"[{doc_id}] Not found in index. Skipping removal.")
+                return
 
-        self.save()
+            self._remove(doc_id)
+            self.db.commit()
         print(f"[{doc_id}] Removed from vector store.")
 
+    def _remove(self, doc_id: str):
+        self._drop_orphaned_vectors(self._unlink(doc_id))
+        self._dirty = True
+
+    def _unlink(self, doc_id: str) -> set:
+        """Deletes a document's metadata rows and returns the vector ids it referenced."""
+        self._fid_lookup = None
+        faiss_ids = {fid for (fid,) in self.db.execute("SELECT fid FROM fid_docs WHERE doc_id = ?", (doc_id,))}
+        self.db.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+        self.db.execute("DELETE FROM fid_docs WHERE doc_id = ?", (doc_id,))
+        return faiss_ids
+
+    def _drop_orphaned_vectors(self, faiss_ids: set):
+        """Removes the vectors among `faiss_ids` that no document references any more."""
+        still_used = {fid for (fid,) in self._select_in("SELECT fid FROM fid_docs WHERE fid IN ({})", list(faiss_ids))}
+        orphans = list(faiss_ids - still_used)
+        if not orphans:
+            return
+        # HNSW graphs can't drop vectors; unmapping the ids is enough for search() to skip them
+        # until flush() compacts the index.
+        if self._hnsw_index() is None:
+            self.index.remove_ids(np.array(orphans, dtype="int64"))
+        self._select_in("DELETE FROM chunk_fids WHERE fid IN ({})", orphans)
+        self._select_in("DELETE FROM chunk_texts WHERE fid IN ({})", orphans)
+
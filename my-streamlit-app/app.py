@@ -1,10 +1,16 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import html
-import time
+import json
 
 st.set_page_config(page_title="RAG Agent", layout="wide")
 
+# One keep-alive session per browser session, so every backend call reuses the same connection
+if "http" not in st.session_state:
+    st.session_state.http = requests.Session()
+    st.session_state.http.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=0))
+
 st.sidebar.title("API Endpoints")
 page = st.sidebar.radio(
     "Choose an option:",
@@ -50,19 +56,26 @@ if page == " Chat with Chatbot":
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    res = requests.post("http://localhost:8000/query", json={"query": user_query})
+                    # Render the answer as the backend streams it (Server-Sent Events)
+                    res = st.session_state.http.post("http://localhost:8000/query/stream", json={"query": user_query}, stream=True)
                     res.raise_for_status()
-                    data = res.json()
-                    answer = data.get("answer", "No answer returned.")
-                    sources = data.get("sources", [])
+                    res.encoding = "utf-8"
                     bot_message = st.empty()
-                   
-                    full_response = ""
-                    for chunk in answer:
-                       full_response += chunk
-                       bot_message.markdown(full_response)
-                       time.sleep(0.005)
-        
+
+                    parts = []
+                    sources = []
+                    for line in res.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[len("data: "):])
+                        if "token" in event:
+                            parts.append(event["token"])
+                            bot_message.markdown("".join(parts))
+                        elif "sources" in event:
+                            sources = event["sources"]
+
+                    answer = "".join(parts) or "No answer returned."
+                    bot_message.markdown(answer)
 
                     if sources:
                         with st.expander("📄 Sources"):
@@ -108,7 +121,7 @@ button = st.sidebar.button("Sync with latest version of Documentation.")
 if button:
     with st.spinner("Syncing..."):
         try:
-            res = requests.post("http://localhost:8000/sync")
+            res = st.session_state.http.post("http://localhost:8000/sync")
             print(res.json())
             st.sidebar.success("Synced successfully")
         except Exception as e:
@@ -140,7 +153,7 @@ elif page == " Ingest Repo":
     if st.button("Ingest"):
         with st.spinner("Upserting..."):
             try:
-                res = requests.post("http://localhost:8000/ingest", json={"repo_url": repo_url, "branch": branch})
+                res = st.session_state.http.post("http://localhost:8000/ingest", json={"repo_url": repo_url, "branch": branch})
                 res.raise_for_status()
                 st.success(res.json()["message"])
             except Exception as e: